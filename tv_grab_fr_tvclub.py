@@ -21,17 +21,17 @@
 
 import argparse
 import datetime
+import gzip
 import logging
 import os
 import re
+import shutil
 import sys
-import urllib
-import urllib.parse
-from urllib.request import Request
+import urllib.error
+from urllib.request import Request, urlopen
 
 import lxml.etree
-from lxml.etree import Element, ElementTree, XMLParser
-import pytz.reference
+from lxml.etree import Element
 
 
 class TVClubXMLTVGrabber:
@@ -40,12 +40,16 @@ class TVClubXMLTVGrabber:
     """
 
     _XMLTV_URL = 'http://guide.tvclub.fr/tvguide.xml'
-    _XMLTV_DATETIME_FORMAT = '%Y%m%d%H%M%S %z'
 
-    _TVCLUB_TIMEZONE = pytz.timezone('Europe/Paris')
+    _CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'tv_grab_fr_tvclub')
+    _CACHE_FILE = os.path.join(_CACHE_DIR, 'tvguide.xml')
+    _CACHE_ETAG_FILE = _CACHE_FILE + '.etag'
+    _CACHE_LAST_MODIFIED_FILE = _CACHE_FILE + '.last-modified'
 
     _MAX_DAYS = 5
 
+    _PROGRAM_TEXT_TAGS = ('title', 'sub-title', 'desc')
+
     _ETSI_PROGRAM_CATEGORIES = {
         'Cinéma': 'Movie / Drama',
         'Clips': 'Music / Ballet / Dance',
@@ -88,48 +92,119 @@ class TVClubXMLTVGrabber:
         u"\x9F": u"\u0178",  # LATIN CAPITAL LETTER Y WITH DIAERESIS
     }
 
+    _WINDOWS_1252_TRANSLATION = str.maketrans(_WINDOWS_1252_UTF_8)
+
     def __init__(self, generator=None, generator_url=None, logger=None):
         self._logger = logger or logging.getLogger(__name__)
 
-        self._xmltv = self._get_programs()
-        self._channels = self._retrieve_available_channels()
+        self._channels = {}
+        self._channel_xmls = {}
+        self._programs = None
+        self._warned_categories = set()
         self._generator = generator
         self._generator_url = generator_url
 
-    def _get_programs(self):
-        """Get TVClub programs in XMLTV format as a XML Element object."""
-
-        self._logger.debug('Getting TVClub programs')
+    def _parse_programs(self, source):
+        """Parse a TVClub XMLTV feed into a list of programme XML Element objects. Available
+        channels, identified by their XMLTV ID, are collected on the fly.
+        """
+
+        programs = []
+        # Process channel and programme elements as they are parsed, detaching each one from the
+        # enclosing document. All elements are retained for later calls, so memory still scales
+        # with the feed contents; the gain over a fromstring parse is that only the scaffolding
+        # tree is discarded, elements are processed while the feed is read, and no second
+        # full-tree pass is needed. The tag filter restricts reporting to these elements, which
+        # the XMLTV DTD only allows as direct children of <tv>, so no recursive tree walk is ever
+        # needed.
+        # collect_ids=False skips the xml:id hash libxml2 would otherwise fill for every element,
+        # and the feed has no DTD, so blank-text removal and entity resolution are useless costs
+        for _, element in lxml.etree.iterparse(source, tag=('channel', 'programme'),
+                                               collect_ids=False, huge_tree=True,
+                                               resolve_entities=False, no_network=True):
+            if element.tag == 'channel':
+                xmltv_id = element.get('id')
+                display_name = element.findtext('display-name')
+                if xmltv_id is not None and display_name is not None:
+                    self._channels[xmltv_id] = {'display_name': display_name}
+                    self._channel_xmls[xmltv_id] = element
+            else:
+                programs.append(element)
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
+        return programs
 
-        self._logger.debug('Retrieveing URL %s', self._XMLTV_URL)
-        request = Request(self._XMLTV_URL)
-        with urllib.request.urlopen(request) as response:
-            return lxml.etree.fromstring(response.read(), parser=XMLParser(remove_blank_text=True))
+    def _get_programs(self):
+        """Get TVClub programs in XMLTV format, as a list of XML Element objects. The feed is only
+        downloaded on first call, and kept in a disk cache so that later runs against an unchanged
+        feed are served by a HTTP conditional request instead of a full download.
+        """
 
-    def _retrieve_available_channels(self):
-        """Retrieve all available channels, identified by their XMLTV ID, from TVClub."""
+        if self._programs is not None:
+            return self._programs
 
-        self._logger.debug('Getting available channels')
+        self._logger.debug('Getting TVClub programs')
 
-        channels = {}
-        for channel in self._xmltv.iter(tag='channel'):
-            xmltv_id = channel.get('id')
-            display_name = channel.findtext('display-name')
-            if xmltv_id is not None and display_name is not None:
-                channels[xmltv_id] = {'display_name': display_name}
+        # XMLTV documents compress very well; ask for a gzipped transfer
+        headers = {'Accept-Encoding': 'gzip'}
+        if os.path.isfile(self._CACHE_FILE):
+            for header, cache_file in (('If-None-Match', self._CACHE_ETAG_FILE),
+                                       ('If-Modified-Since', self._CACHE_LAST_MODIFIED_FILE)):
+                if os.path.isfile(cache_file):
+                    with open(cache_file, 'r') as cache:
+                        headers[header] = cache.read().strip()
 
-        return channels
+        self._logger.debug('Retrieveing URL %s', self._XMLTV_URL)
+        request = Request(self._XMLTV_URL, headers=headers)
+        try:
+            with urlopen(request) as response:
+                source = response
+                if response.headers.get('Content-Encoding') == 'gzip':
+                    source = gzip.GzipFile(fileobj=response)
+                os.makedirs(self._CACHE_DIR, exist_ok=True)
+                # Download to a temporary file and only move it into place once complete, so that
+                # an interrupted download never leaves a truncated cache behind
+                cache_tmp_file = self._CACHE_FILE + '.tmp'
+                with open(cache_tmp_file, 'wb') as cache:
+                    shutil.copyfileobj(source, cache)
+                os.replace(cache_tmp_file, self._CACHE_FILE)
+                for header, cache_file in (('ETag', self._CACHE_ETAG_FILE),
+                                           ('Last-Modified', self._CACHE_LAST_MODIFIED_FILE)):
+                    value = response.headers.get(header)
+                    if value is not None:
+                        with open(cache_file, 'w') as cache:
+                            cache.write(value)
+                    elif os.path.isfile(cache_file):
+                        # Drop validators the new response no longer carries, so that a stale one
+                        # can never describe a body it does not match
+                        os.remove(cache_file)
+        except urllib.error.HTTPError as error:
+            if error.code != 304:
+                raise
+            self._logger.debug('TVClub feed not modified, reusing cached copy %s',
+                               self._CACHE_FILE)
+
+        with open(self._CACHE_FILE, 'rb') as cache:
+            self._programs = self._parse_programs(cache)
+
+        return self._programs
 
     def get_available_channels(self):
         """Return the list of all available channels from TVClub, as a dictionary."""
 
+        # Channels are collected while the program feed is parsed
+        self._get_programs()
+
         return self._channels
 
     def _etsi_category(self, category):
         """Translate TVClub program category to ETSI EN 300 468 category."""
 
         etsi_category = self._ETSI_PROGRAM_CATEGORIES.get(category)
-        if etsi_category is None:
+        if etsi_category is None and category not in self._warned_categories:
+            # Only warn once per category, not once per programme
+            self._warned_categories.add(category)
             self._logger.warning('TVClub category %s has no defined ETSI equivalent', category)
 
         return etsi_category
@@ -137,7 +212,12 @@ class TVClubXMLTVGrabber:
     def _fix_windows_1252(self, text):
         """Replace in a string all Windows-1252 specific chars to UTF-8."""
 
-        return ''.join([self._WINDOWS_1252_UTF_8.get(c, c) for c in text])
+        # Most feed texts are plain ASCII and cannot contain Windows-1252 specific chars; isascii
+        # is a single C-level scan that lets them skip the translate call (and its copy) entirely
+        if text.isascii():
+            return text
+
+        return text.translate(self._WINDOWS_1252_TRANSLATION)
 
     def _update_program_xmltv(self, program_xml):
         """Fix a TVClub program XML Element to comply the XMLTV standard."""
@@ -145,22 +225,23 @@ class TVClubXMLTVGrabber:
         # Although TVClub programs are supposed to be encoded in UTF-8, some texts may be encoded in
         # Windows-1252
 
-        for text in 'title', 'sub-title', 'desc':
-            xml = program_xml.find(text)
-            if xml is not None:
-                xml.text = self._fix_windows_1252(xml.text).strip()
-                if text == 'sub-title':
-                    xml.set('lang', 'fr')
+        fix_windows_1252 = self._fix_windows_1252
 
-        # Description
-        desc_xml = program_xml.find('desc')
-        if desc_xml is not None:
-            desc = self._fix_windows_1252(desc_xml.text).strip()
-            desc_xml.text = desc
-            desc_xml.set('lang', 'fr')
+        # Locate all the elements to fix in a single pass over the programme children, instead of
+        # one find traversal per tag; only the first element per tag is kept, as find would do
+        children = {}
+        for child_xml in program_xml:
+            children.setdefault(child_xml.tag, child_xml)
+
+        for text in self._PROGRAM_TEXT_TAGS:
+            xml = children.get(text)
+            if xml is not None and xml.text is not None:
+                xml.text = fix_windows_1252(xml.text).strip()
+                if text in ('sub-title', 'desc'):
+                    xml.set('lang', 'fr')
 
         # Categories
-        category_xml = program_xml.find('category')
+        category_xml = children.get('category')
         if category_xml is not None:
             category = category_xml.text.strip()
             if category != '':
@@ -168,77 +249,78 @@ class TVClubXMLTVGrabber:
                 if etsi_category is not None and etsi_category != '':
                     etsi_category_xml = Element('category')
                     etsi_category_xml.text = etsi_category
-                    index = category_xml.getparent().index(category_xml)
-                    program_xml.insert(index, etsi_category_xml)
+                    category_xml.addprevious(etsi_category_xml)
 
     @staticmethod
     def _get_program_id(program_xml):
         """Generate a unique ID for a XMLTV program, based on its channel, its start and stop times,
         and its title.  """
 
-        return '{}|{}|{}|{}'.format(program_xml.get('channel', ''),
-                                    program_xml.get('start', ''),
-                                    program_xml.get('stop', ''),
-                                    program_xml.findtext('title', ''))
+        return (program_xml.get('channel', ''), program_xml.get('start', ''),
+                program_xml.get('stop', ''), program_xml.findtext('title', ''))
 
     def _get_xmltv_data(self, xmltv_ids, days=1, offset=0):
-        """Get TVClub program data in XMLTV format as XML ElementTree object.  """
+        """Get TVClub program data in XMLTV format, as a generator of channel and programme XML
+        Element objects in XMLTV document order.
+        """
 
         if days + offset > self._MAX_DAYS:
             self._logger.warning('Grabber can only fetch programs up to %i days in the future.',
                                  self._MAX_DAYS)
             days = min(self._MAX_DAYS - offset, self._MAX_DAYS)
 
-        root_xml = Element(
-            'tv',
-            attrib={'source-info-name': 'TVClub',
-                    'source-info-url': 'http://forum.tvclub.fr/programmes-epg/index.php',
-                    'source-data-url': self._XMLTV_URL}
-        )
-        if self._generator is not None:
-            root_xml.set('generator-info-name', self._generator)
-        if self._generator_url is not None:
-            root_xml.set('generator-info-url', self._generator_url)
+        # Ensure the feed has been fetched, so that the channel map is filled
+        programs = self._get_programs()
 
-        for channel_xml in self._xmltv.iter(tag='channel'):
-            # Only keep channels for selected XMLTV IDs
-            if channel_xml.get('id') in xmltv_ids:
-                root_xml.append(channel_xml)
+        # Only keep channels for selected XMLTV IDs, in configuration order
+        for xmltv_id in dict.fromkeys(xmltv_ids):
+            channel_xml = self._channel_xmls.get(xmltv_id)
+            if channel_xml is not None:
+                yield channel_xml
 
-        program_ids = []
-        start = datetime.datetime.combine(datetime.date.today(), datetime.time(0),
-                                          tzinfo=pytz.reference.LocalTimezone())
-        start = start + datetime.timedelta(days=offset)
-        stop = start + datetime.timedelta(days=days)
+        program_ids = set()
+        first_day = datetime.date.today() + datetime.timedelta(days=offset)
+        last_day = first_day + datetime.timedelta(days=days - 1)
+        first_day = first_day.strftime('%Y%m%d')
+        last_day = last_day.strftime('%Y%m%d')
 
-        for program_xml in self._xmltv.iter(tag='programme'):
+        for program_xml in programs:
             # TVClub data contain programs starting between 5:00 AM and 4:59 AM 4 days later. Ignore
-            # programs outside the fetch range.
-            program_start = datetime.datetime.strptime(program_xml.get('start'),
-                                                       self._XMLTV_DATETIME_FORMAT)
-            program_stop = datetime.datetime.strptime(program_xml.get('stop'),
-                                                      self._XMLTV_DATETIME_FORMAT)
-            if program_stop < start or program_start > stop:
+            # programs outside the fetch range. XMLTV start/stop attributes begin with a zero-padded
+            # YYYYMMDD date, so comparing these prefixes lexicographically is equivalent to
+            # comparing dates, without a costly strptime call per programme.
+            if program_xml.get('stop')[:8] < first_day or program_xml.get('start')[:8] > last_day:
                 continue
 
             # Ignore duplicate programs
             program_id = self._get_program_id(program_xml)
             if program_id in program_ids:
                 continue
-            program_ids.append(program_id)
+            program_ids.add(program_id)
 
             self._update_program_xmltv(program_xml)
-            root_xml.append(program_xml)
-
-        return ElementTree(root_xml)
+            yield program_xml
 
     def write_xmltv(self, xmltv_ids, output_file, days=1, offset=0):
         """Grab TVClub programs in XMLTV format and write them to file."""
 
         self._logger.debug('Writing XMLTV program to file %s', output_file)
 
-        xmltv_data = self._get_xmltv_data(xmltv_ids, days, offset)
-        xmltv_data.write(output_file, encoding='UTF-8', xml_declaration=True, pretty_print=True)
+        attribs = {'source-info-name': 'TVClub',
+                   'source-info-url': 'http://forum.tvclub.fr/programmes-epg/index.php',
+                   'source-data-url': self._XMLTV_URL}
+        if self._generator is not None:
+            attribs['generator-info-name'] = self._generator
+        if self._generator_url is not None:
+            attribs['generator-info-url'] = self._generator_url
+
+        # Write each element to the output as soon as it is produced, instead of materializing the
+        # whole XMLTV document in memory first
+        with lxml.etree.xmlfile(output_file, encoding='UTF-8') as xmltv_file:
+            xmltv_file.write_declaration()
+            with xmltv_file.element('tv', attrib=attribs):
+                for element_xml in self._get_xmltv_data(xmltv_ids, days, offset):
+                    xmltv_file.write(element_xml, pretty_print=True)
 
 
 _PROGRAM = 'tv_grab_fr_tvclub'
@@ -251,11 +333,13 @@ _CAPABILITIES = ['baseline', 'manualconfig']
 _DEFAULT_DAYS = 1
 _DEFAULT_OFFSET = 0
 
-_DEFAULT_CONFIG_FILE = os.path.join(os.environ['HOME'], '.xmltv',
+_DEFAULT_CONFIG_FILE = os.path.join(os.path.expanduser('~'), '.xmltv',
                                     _PROGRAM + '.conf')
 
 _DEFAULT_OUTPUT = '/dev/stdout'
 
+_CHANNEL_RE = re.compile(r'(?m)^\s*channel\s*=\s*(\S.*?)\s*$')
+
 
 def _print_description():
     """Print the description for the grabber."""
@@ -321,22 +405,15 @@ def _parse_cli_args():
 def _read_configuration(config_file=_DEFAULT_CONFIG_FILE):
     """Load channel XMLTV IDs from the configuration file."""
 
-    xmltv_ids = []
     with open(config_file, 'r') as config:
-        for line in config:
-            match = re.search(r'^\s*channel\s*=\s*(.+)\s*$', line)
-            if match is not None:
-                xmltv_ids.append(match.group(1))
-
-    return xmltv_ids
+        return _CHANNEL_RE.findall(config.read())
 
 
 def _write_configuration(xmltv_ids, config_file=_DEFAULT_CONFIG_FILE):
     """Write specified channels to the specified configuration file."""
 
     config_dir = os.path.dirname(os.path.abspath(config_file))
-    if not os.path.exists(config_dir):
-        os.mkdir(config_dir)
+    os.makedirs(config_dir, exist_ok=True)
 
     with open(config_file, 'w') as config:
         for xmltv_id in xmltv_ids:
@@ -377,11 +454,10 @@ def _configure(available_channels, config_file=_DEFAULT_CONFIG_FILE):
 def _main():
     """Main execution path."""
 
-    logger = logging.getLogger(__name__)
-    logger.addHandler(logging.StreamHandler())
-
     args = _parse_cli_args()
 
+    # Handle metadata flags before any other setup; XMLTV tooling probes grabbers with these
+    # repeatedly, so they must stay as cheap as possible
     if args.version:
         _print_version()
         sys.exit()
@@ -394,6 +470,9 @@ def _main():
         _print_capabilities()
         sys.exit()
 
+    logger = logging.getLogger(__name__)
+    logger.addHandler(logging.StreamHandler())
+
     if args.debug:
         log_level = logging.DEBUG
     elif args.quiet:
@@ -404,12 +483,11 @@ def _main():
     logger.setLevel(log_level)
 
     tvclub = TVClubXMLTVGrabber(generator=_PROGRAM, generator_url=__url__, logger=logger)
-    available_channels = tvclub.get_available_channels()
 
     logger.info('Using configuration file %s', args.config_file)
 
     if args.configure:
-        _configure(available_channels, args.config_file)
+        _configure(tvclub.get_available_channels(), args.config_file)
         sys.exit()
 
     if not os.path.isfile(args.config_file):